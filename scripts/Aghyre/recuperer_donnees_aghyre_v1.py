@@ -12,6 +12,8 @@ import datetime as dt
 import os
 import sys
 import json
+import gzip
+import hashlib
 import urllib3
 import pandas as pd
 import requests
@@ -64,6 +66,12 @@ def get_params(input_file):
         params['DT'].remove('')
     # résultat
     params["RESULTATS"]=config.get('params','RESULTATS')
+    # cache des observations des fenêtres historiques closes (optionnel : pas de cache si non précisé)
+    params["CACHE"] = config.get('params', 'CACHE', fallback=None)
+    # taille maximale du cache en Mo
+    params["CACHE_TAILLE_MAX"] = config.getfloat('params', 'CACHE_TAILLE_MAX', fallback=200.)
+    # délai en jours avant lequel les données sont considérées comme consolidées (fenêtre close)
+    params["CACHE_DELAI"] = config.getint('params', 'CACHE_DELAI', fallback=31)
     return params
 
 #-------------------------------------------------------------------------------
@@ -93,18 +101,204 @@ def lire_fichiers_rubriques(liste_fic):
 
 #-------------------------------------------------------------------------------
 
+# URL du webservice de diffusion des données
+URL_DONNEES = 'https://www.vnf.fr/aghyre/api/diffusion/donnees'
+
+#-------------------------------------------------------------------------------
+
+class CacheObservations():
+    """
+    cache persistant sur disque des observations des fenêtres historiques closes.
+    Chaque fenêtre est enregistrée sous la forme d'une liste d'observations au format
+    json, compressée (gzip), dans un fichier nommé par l'empreinte de la clé
+    (rubriques, dateDebut, dateFin). Une fenêtre sans données est enregistrée
+    comme une liste vide.
+    La date de modification des fichiers sert à l'éviction LRU lorsque la taille
+    totale dépasse la taille maximale.
+    """
+
+    # âge en secondes au-delà duquel un fichier temporaire est considéré comme abandonné
+    AGE_MAX_TEMPORAIRE = 3600
+
+    def __init__(self, dossier, taille_max_mo=200.):
+        """
+        Constructeur
+
+        Args:
+            dossier (str): dossier de stockage du cache, créé si besoin
+            taille_max_mo (float): taille maximale du cache en Mo
+        """
+        self.dossier = dossier
+        self.taille_max = int(taille_max_mo * 1024 * 1024)
+        os.makedirs(self.dossier, exist_ok=True)
+
+
+    @staticmethod
+    def cle(rubriques, debut, fin):
+        """Renvoie l'empreinte de la fenêtre à partir des rubriques et des dates de début et de fin
+
+        Args:
+            rubriques (list): identifiants des rubriques
+            debut (datetime): date de début de la fenêtre
+            fin (datetime): date de fin de la fenêtre
+
+        Returns:
+            str: empreinte hexadécimale
+        """
+        texte = json.dumps([list(rubriques),
+                            debut.strftime("%Y-%m-%dT%H:%M:%S"),
+                            fin.strftime("%Y-%m-%dT%H:%M:%S")])
+        return hashlib.sha256(texte.encode('utf-8')).hexdigest()
+
+
+    def _chemin(self, cle):
+        """Renvoie le chemin du fichier de l'entrée
+        """
+        return os.path.join(self.dossier, cle + '.json.gz')
+
+
+    def lire(self, cle):
+        """Renvoie les observations en cache, ou None si absentes.
+        Une entrée illisible est supprimée.
+
+        Args:
+            cle (str): empreinte de la fenêtre
+
+        Returns:
+            list: observations de la fenêtre
+        """
+        chemin = self._chemin(cle)
+        if not os.path.exists(chemin):
+            return None
+        try:
+            with gzip.open(chemin, 'rb') as f:
+                observations = json.loads(f.read())
+        except (OSError, EOFError, ValueError):
+            # entrée corrompue : suppression
+            self.supprimer(cle)
+            return None
+        # mise à jour de la date d'accès pour l'éviction LRU
+        os.utime(chemin)
+        return observations
+
+
+    def ecrire(self, cle, observations):
+        """Enregistre les observations d'une fenêtre dans le cache.
+        Une entrée plus grande que la taille maximale du cache n'est pas enregistrée.
+
+        Args:
+            cle (str): empreinte de la fenêtre
+            observations (list): observations de la fenêtre
+        """
+        donnees = gzip.compress(json.dumps(observations).encode('utf-8'))
+        if len(donnees) > self.taille_max:
+            return
+        chemin = self._chemin(cle)
+        # écriture dans un fichier temporaire puis renommage pour éviter
+        # les entrées partielles en cas d'interruption
+        with open(chemin + '.tmp', 'wb') as f:
+            f.write(donnees)
+        os.replace(chemin + '.tmp', chemin)
+
+
+    def supprimer(self, cle):
+        """Supprime une entrée du cache
+
+        Args:
+            cle (str): empreinte de la fenêtre
+        """
+        chemin = self._chemin(cle)
+        if os.path.exists(chemin):
+            os.remove(chemin)
+
+
+    def evincer(self):
+        """Supprime les fichiers temporaires abandonnés puis les entrées les moins
+        récemment utilisées tant que la taille du cache dépasse la taille maximale.
+        À appeler une fois en fin de traitement.
+        """
+        maintenant = dt.datetime.now().timestamp()
+        entrees = []
+        for nom in os.listdir(self.dossier):
+            chemin = os.path.join(self.dossier, nom)
+            stat = os.stat(chemin)
+            if nom.endswith('.tmp'):
+                # fichier temporaire laissé par une écriture interrompue
+                if maintenant - stat.st_mtime > self.AGE_MAX_TEMPORAIRE:
+                    os.remove(chemin)
+            elif nom.endswith('.json.gz'):
+                entrees.append((stat.st_mtime, stat.st_size, nom[:-len('.json.gz')]))
+        taille = sum(e[1] for e in entrees)
+        # les plus anciennes en premier
+        for _, taille_entree, cle in sorted(entrees):
+            if taille <= self.taille_max:
+                break
+            self.supprimer(cle)
+            taille -= taille_entree
+
+#-------------------------------------------------------------------------------
+
 class ClientAghyre():
     """
     classe de gestion de la session de connexion au webservice
     """
 
 
-    def __init__(self):
+    def __init__(self, cache=None, delai_consolidation=31):
         """
         Constructeur
+
+        Args:
+            cache (CacheObservations): cache optionnel des observations des fenêtres closes
+            delai_consolidation (int): nombre de jours avant aujourd'hui au-delà
+            duquel les données sont considérées comme définitives
         """
         self.session = requests.Session()
         self.session.verify=False
+        self.cache = cache
+        self.delai_consolidation = delai_consolidation
+
+
+    def limite_consolidation(self):
+        """Renvoie la date limite des fenêtres closes : premier jour du mois de la date
+        (aujourd'hui - délai de consolidation).
+
+        Returns:
+            datetime: date limite
+        """
+        date = dt.datetime.now() - dt.timedelta(days=self.delai_consolidation)
+        return dt.datetime(date.year, date.month, 1)
+
+
+    def decouper_periode(self, debut, fin):
+        """Découpe la période de requête en fenêtres historiques closes et une
+        fenêtre récente ouverte. Les fenêtres closes suivent le calendrier : une par
+        année pour les années révolues, une par mois pour l'année de la date limite,
+        de sorte que leurs bornes ne changent plus une fois closes.
+
+        Args:
+            debut (datetime): date de début de la période de requête
+            fin (datetime): date de fin de la période de requête
+
+        Returns:
+            (list((datetime, datetime)), (datetime, datetime)): liste des fenêtres closes (début, fin)
+            et fenêtre ouverte, None si la période est entièrement close
+        """
+        limite = self.limite_consolidation()
+        fenetres = []
+        date = debut
+        while date < min(fin, limite):
+            if date.year < limite.year or date.month == 12:
+                suivante = dt.datetime(date.year + 1, 1, 1)
+            else:
+                suivante = dt.datetime(date.year, date.month + 1, 1)
+            fenetres.append((date, min(suivante - dt.timedelta(seconds=1), fin)))
+            date = suivante
+        # fenêtre récente
+        fenetre_ouverte = None
+        if fin >= limite:
+            fenetre_ouverte = (max(debut, limite), fin)
+        return fenetres, fenetre_ouverte
 
 
     def request(self, method, url, **kwargs):
@@ -133,26 +327,81 @@ class ClientAghyre():
         # renvoi du contenu de la réponse
         return response.content
 
+
+    def observations(self, id_aghyre, debut, fin):
+        """Renvoie les observations de la rubrique sur la période.
+        Avec le cache, les fenêtres closes absentes du cache sont récupérées en une
+        seule requête puis découpées localement et enregistrées, y compris les fenêtres
+        sans données. La fenêtre ouverte est toujours redemandée.
+
+        Args:
+            id_aghyre (str): identifiant de la rubrique
+            debut (datetime): date de début de la période de requête
+            fin (datetime): date de fin de la période de requête
+
+        Returns:
+            list: observations (dict avec notamment DtObsHydro et ResObsHydro)
+        """
+        param_url = [id_aghyre]
+        # sans cache : requête directe
+        if self.cache is None:
+            return lire_flux_sandre(self.request('POST', URL_DONNEES, param_url=param_url, debut=debut, fin=fin))
+
+        fenetres, fenetre_ouverte = self.decouper_periode(debut, fin)
+        cles = [self.cache.cle(param_url, d, f) for d, f in fenetres]
+        en_cache = [self.cache.lire(cle) for cle in cles]
+        manquantes = [i for i, obs in enumerate(en_cache) if obs is None]
+        if manquantes:
+            # une seule requête couvrant les fenêtres manquantes
+            debut_requete = fenetres[manquantes[0]][0]
+            fin_requete = fenetres[manquantes[-1]][1]
+            recues = lire_flux_sandre(self.request('POST', URL_DONNEES, param_url=param_url,
+                                                   debut=debut_requete, fin=fin_requete))
+            dates = [dt.datetime.fromisoformat(obs['DtObsHydro']).replace(tzinfo=None) for obs in recues]
+            for i in manquantes:
+                debut_fenetre, fin_fenetre = fenetres[i]
+                en_cache[i] = [obs for obs, date in zip(recues, dates) if debut_fenetre <= date <= fin_fenetre]
+                self.cache.ecrire(cles[i], en_cache[i])
+
+        resultat = [obs for obs_fenetre in en_cache for obs in obs_fenetre]
+        if fenetre_ouverte is not None:
+            resultat += lire_flux_sandre(self.request('POST', URL_DONNEES, param_url=param_url,
+                                                      debut=fenetre_ouverte[0], fin=fenetre_ouverte[1]))
+        return resultat
+
 #-------------------------------------------------------------------------------
 
-def recuperation_donnees(client, id_aghyre, debut, fin) :
-    """
-    Renvoie un  texte contenant les données correspondantes à la requête
+def lire_flux_sandre(flux_sandre):
+    """Lecture d'un flux xml sandre renvoyé par le webservice
+
+    Args:
+        flux_sandre (bytes): contenu de la réponse du webservice
+
+    Returns:
+        list: observations de la série, liste vide si le flux ne contient pas de série
     """
-    # URL des requêtes
-    param_url = [id_aghyre]
-    flux_sandre = client.request('POST', 'https://www.vnf.fr/aghyre/api/diffusion/donnees', param_url=param_url, debut=debut, fin=fin)
     # utilisation de libhydo pour deserialiser le flux xml sandre
     message = Message.from_string(flux_sandre, strict=False)
     # désérialisation du message dans un dict avec format json
     dico = json.loads(message.to_json())
 
-    # dataframe contenant la série temporelle des données récupérées
+    # observations de la série temporelle récupérée
     try:
-        df = pd.DataFrame.from_records(dico['Donnees']['SeriesObsHydro'][0]["ObssHydro"])
-    except Exception as e:
-        print(e)
-        raise IOError(f" !! Echec de récupération des données pour la rubrique {id_aghyre} : pas de données !!") from e
+        return dico['Donnees']['SeriesObsHydro'][0]["ObssHydro"]
+    except (KeyError, IndexError, TypeError):
+        return []
+
+#-------------------------------------------------------------------------------
+
+def recuperation_donnees(client, id_aghyre, debut, fin) :
+    """
+    Renvoie un dataframe contenant les données correspondantes à la requête
+    """
+    observations = client.observations(id_aghyre, debut, fin)
+    # dataframe contenant la série temporelle des données récupérées
+    if len(observations) == 0:
+        raise IOError(f" !! Echec de récupération des données pour la rubrique {id_aghyre} : pas de données !!")
+    df = pd.DataFrame.from_records(observations)
     # fin
     return df
 
@@ -240,8 +489,13 @@ def main():
     # lecture des fichiers des rubriques à récupérer
     dico_rubriques = lire_fichiers_rubriques(params['FIC_RUBRIQUES'])
 
+    # cache optionnel des observations des fenêtres historiques closes
+    cache = None
+    if params['CACHE']:
+        cache = CacheObservations(params['CACHE'], params['CACHE_TAILLE_MAX'])
+
     # client pour faire les requêtes
-    client = ClientAghyre()
+    client = ClientAghyre(cache, params['CACHE_DELAI'])
 
     # indice initial poru les pas de temps (params['DT'])
     i=0
@@ -261,6 +515,10 @@ def main():
         # incrément de i pour le pas de temps suivant
         i+=1
 
+    # limitation de la taille du cache
+    if cache is not None:
+        cache.evincer()
+
 #-------------------------------------------------------------------------------
 #-------------------------------------------------------------------------------
 
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*----------------------------------------------------------
+# Name:        test_recuperer_donnees_aghyre_v1
+# Purpose:     Tests du cache des observations et du découpage des requêtes aGHyre,
+#              sans accès au réseau (session du client remplacée)
+#
+# Licence:     GPL V3
+#-------------------------------------------------------------------------------
+
+import datetime as dt
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'scripts', 'Aghyre'))
+import recuperer_donnees_aghyre_v1 as aghyre
+
+from libhydro.conv.xml import Message, Scenario
+from libhydro.core import intervenant, obshydro, sitehydro
+
+LIMITE = dt.datetime(2026, 9, 1)
+SECONDE = dt.timedelta(seconds=1)
+
+#-------------------------------------------------------------------------------
+
+class Reponse():
+    """réponse HTTP simulée"""
+
+    def __init__(self, status_code, content=b''):
+        self.status_code = status_code
+        self.content = content
+
+
+class Session():
+    """session simulée : renvoie en json les observations des dates fournies
+    comprises dans la période demandée et enregistre les requêtes reçues"""
+
+    def __init__(self, dates):
+        self.dates = dates
+        self.requetes = []
+
+    def request(self, method, url, json=None):
+        self.requetes.append((json['dateDebut'], json['dateFin']))
+        debut = dt.datetime.fromisoformat(json['dateDebut'])
+        fin = dt.datetime.fromisoformat(json['dateFin'])
+        observations = [{'DtObsHydro': date.isoformat(), 'ResObsHydro': 1.}
+                        for date in self.dates if debut <= date <= fin]
+        return Reponse(200, json_dumps(observations))
+
+
+def json_dumps(observations):
+    return json.dumps(observations).encode('utf-8')
+
+
+@pytest.fixture
+def flux_json(monkeypatch):
+    """remplace la lecture du flux sandre par une lecture json"""
+    monkeypatch.setattr(aghyre, 'lire_flux_sandre', json.loads)
+
+
+def creer_client(dossier, dates, taille_max_mo=200.):
+    """client avec cache et date limite fixée"""
+    client = aghyre.ClientAghyre(aghyre.CacheObservations(str(dossier), taille_max_mo))
+    client.session = Session(dates)
+    client.limite_consolidation = lambda: LIMITE
+    return client
+
+#-------------------------------------------------------------------------------
+
+def test_lire_flux_sandre():
+    scenario = Scenario(emetteur=intervenant.Contact(code='1', intervenant=intervenant.Intervenant(code='13120003100017')),
+                        destinataire=intervenant.Intervenant(code='13120003100017'))
+    observations = obshydro.Observations(obshydro.Observation('2020-01-01 10:00', 12.5))
+    serie = obshydro.Serie(entite=sitehydro.Sitehydro('A1234567'), grandeur='Q',
+                           dtdeb=dt.datetime(2020, 1, 1), dtfin=dt.datetime(2020, 1, 2),
+                           dtprod=dt.datetime(2020, 1, 2), observations=observations)
+    flux = Message(scenario=scenario, serieshydro=[serie]).to_string()
+    resultat = aghyre.lire_flux_sandre(flux)
+    assert [(obs['DtObsHydro'], obs['ResObsHydro']) for obs in resultat] == [('2020-01-01T10:00:00', 12.5)]
+    # message sans série
+    assert aghyre.lire_flux_sandre(Message(scenario=scenario).to_string()) == []
+
+
+def test_cle_stable_et_distincte():
+    debut, fin = dt.datetime(2020, 1, 1), dt.datetime(2020, 12, 31, 23, 59, 59)
+    cle = aghyre.CacheObservations.cle
+    assert cle(['1'], debut, fin) == cle(['1'], debut, fin)
+    assert cle(['1'], debut, fin) != cle(['2'], debut, fin)
+    assert cle(['1'], debut, fin) != cle(['1'], debut, fin - SECONDE)
+
+
+def test_decouper_periode_calendrier(tmp_path):
+    client = creer_client(tmp_path, [])
+    debut, fin = dt.datetime(2024, 6, 15), dt.datetime(2026, 10, 19, 12)
+    fenetres, ouverte = client.decouper_periode(debut, fin)
+    assert fenetres[0] == (debut, dt.datetime(2025, 1, 1) - SECONDE)
+    assert fenetres[1] == (dt.datetime(2025, 1, 1), dt.datetime(2026, 1, 1) - SECONDE)
+    # un mois par fenêtre pour l'année de la date limite
+    assert fenetres[2] == (dt.datetime(2026, 1, 1), dt.datetime(2026, 2, 1) - SECONDE)
+    assert fenetres[-1] == (dt.datetime(2026, 8, 1), LIMITE - SECONDE)
+    assert len(fenetres) == 2 + 8
+    assert ouverte == (LIMITE, fin)
+    # le mois suivant, les fenêtres closes précédentes sont inchangées
+    client.limite_consolidation = lambda: dt.datetime(2026, 10, 1)
+    suivantes, _ = client.decouper_periode(debut, fin)
+    assert suivantes == fenetres + [(LIMITE, dt.datetime(2026, 10, 1) - SECONDE)]
+
+
+def test_decouper_periode_fin_historique(tmp_path):
+    client = creer_client(tmp_path, [])
+    debut, fin = dt.datetime(2023, 1, 1), dt.datetime(2023, 12, 31)
+    assert client.decouper_periode(debut, fin) == ([(debut, fin)], None)
+
+#-------------------------------------------------------------------------------
+
+def test_sans_cache(flux_json):
+    client = aghyre.ClientAghyre()
+    client.session = Session([dt.datetime(2020, 5, 1)])
+    observations = client.observations('1', dt.datetime(2000, 1, 1), dt.datetime(2026, 10, 19))
+    assert len(observations) == 1
+    assert client.session.requetes == [('2000-01-01T00:00:00', '2026-10-19T00:00:00')]
+
+
+def test_historique_en_une_requete_puis_en_cache(tmp_path, flux_json):
+    dates = [dt.datetime(2020, 5, 1), dt.datetime(2026, 3, 10), dt.datetime(2026, 10, 1)]
+    client = creer_client(tmp_path, dates)
+    debut, fin = dt.datetime(2000, 1, 1), dt.datetime(2026, 10, 19)
+    for _ in range(2):
+        observations = client.observations('1', debut, fin)
+        assert [obs['DtObsHydro'] for obs in observations] == [date.isoformat() for date in dates]
+    # 1 requête pour l'historique et 1 pour la fenêtre ouverte, puis la fenêtre ouverte seule
+    assert client.session.requetes == [('2000-01-01T00:00:00', '2026-08-31T23:59:59'),
+                                       ('2026-09-01T00:00:00', '2026-10-19T00:00:00'),
+                                       ('2026-09-01T00:00:00', '2026-10-19T00:00:00')]
+    # les fenêtres sans données sont aussi en cache
+    fenetres, _ = client.decouper_periode(debut, fin)
+    assert len(os.listdir(tmp_path)) == len(fenetres)
+
+
+def test_nouveau_mois_une_seule_petite_requete(tmp_path, flux_json):
+    client = creer_client(tmp_path, [dt.datetime(2026, 9, 15)])
+    debut, fin = dt.datetime(2000, 1, 1), dt.datetime(2026, 10, 19)
+    client.observations('1', debut, fin)
+    client.limite_consolidation = lambda: dt.datetime(2026, 10, 1)
+    client.session.requetes = []
+    observations = client.observations('1', debut, fin)
+    assert [obs['DtObsHydro'] for obs in observations] == ['2026-09-15T00:00:00']
+    assert client.session.requetes == [('2026-09-01T00:00:00', '2026-09-30T23:59:59'),
+                                       ('2026-10-01T00:00:00', '2026-10-19T00:00:00')]
+
+
+def test_flux_illisible_non_mis_en_cache(tmp_path, monkeypatch):
+    def lire(flux):
+        raise ValueError("flux xml mal formé")
+    monkeypatch.setattr(aghyre, 'lire_flux_sandre', lire)
+    client = creer_client(tmp_path, [])
+    with pytest.raises(ValueError):
+        client.observations('1', dt.datetime(2020, 1, 1), dt.datetime(2020, 12, 31))
+    assert os.listdir(tmp_path) == []
+
+
+def test_entree_corrompue_supprimee(tmp_path, flux_json):
+    client = creer_client(tmp_path, [dt.datetime(2020, 5, 1)])
+    debut, fin = dt.datetime(2020, 1, 1), dt.datetime(2020, 12, 31)
+    cle = client.cache.cle(['1'], debut, fin)
+    with open(os.path.join(tmp_path, cle + '.json.gz'), 'wb') as f:
+        f.write(b'<bad')
+    assert len(client.observations('1', debut, fin)) == 1
+    assert len(client.session.requetes) == 1
+    assert len(client.cache.lire(cle)) == 1
+
+
+def test_recuperation_donnees_aucune_donnee(tmp_path, flux_json):
+    client = creer_client(tmp_path, [])
+    with pytest.raises(IOError):
+        aghyre.recuperation_donnees(client, '1', dt.datetime(2025, 1, 1), dt.datetime(2026, 10, 19))
+
+#-------------------------------------------------------------------------------
+
+def test_eviction_lru(tmp_path):
+    cache = aghyre.CacheObservations(str(tmp_path), taille_max_mo=0.7)
+    # observations peu compressibles d'environ 300 ko chacune une fois compressées
+    blocs = [[os.urandom(300 * 1024).hex()] for _ in range(3)]
+    for cle, bloc in zip('abc', blocs):
+        cache.ecrire(cle, bloc)
+    os.utime(os.path.join(tmp_path, 'a.json.gz'), (0, 0))
+    os.utime(os.path.join(tmp_path, 'b.json.gz'), (1, 1))
+    os.utime(os.path.join(tmp_path, 'c.json.gz'), (2, 2))
+    # utilisation de 'a' : 'b' devient la moins récemment utilisée
+    assert cache.lire('a') == blocs[0]
+    cache.evincer()
+    assert cache.lire('b') is None
+    assert cache.lire('a') == blocs[0]
+    assert cache.lire('c') == blocs[2]
+
+
+def test_entree_trop_grande_non_enregistree(tmp_path):
+    cache = aghyre.CacheObservations(str(tmp_path), taille_max_mo=0.1)
+    cache.ecrire('a', [os.urandom(200 * 1024).hex()])
+    assert os.listdir(tmp_path) == []
+
+
+def test_eviction_temporaires_abandonnes(tmp_path):
+    cache = aghyre.CacheObservations(str(tmp_path))
+    ancien = os.path.join(tmp_path, 'a.json.gz.tmp')
+    recent = os.path.join(tmp_path, 'b.json.gz.tmp')
+    for chemin in (ancien, recent):
+        with open(chemin, 'wb') as f:
+            f.write(b'partiel')
+    os.utime(ancien, (0, 0))
+    cache.evincer()
+    assert not os.path.exists(ancien)
+    assert os.path.exists(recent)